@@ -1,32 +1,70 @@
 #!/usr/bin/env python3
 
 import appdirs
-from collections import defaultdict
+import bisect
+from collections import defaultdict, deque, namedtuple
 import glob
-import gzip
+import hashlib
 import json
 import os
-import math
-import portion
+import pickle
 import radix
+import re
 import shutil
 import sys
+import threading
+import weakref
 import csv
+import functools
+import io
+import itertools
 import lzma
-from io import BytesIO
 
 import urllib
 import urllib.request as request
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from contextlib import closing
+from typing import Iterable, Tuple
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+# ISA-L decompression is a few times faster than zlib
+try:
+    from isal.igzip import IGzipFile as GzipFile
+except ImportError:
+    from gzip import GzipFile
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 CACHE_DIR = appdirs.user_cache_dir('rov', 'IHR')
 
 DEFAULT_IRR_DIR = CACHE_DIR+'/db/irr/'
 IRR_FNAME = '*.gz'
+IRR_READ_BUFFER_SIZE = 1 << 20
+# Attributes of IRR route objects that are stored
+IRR_FIELDS = (b'route:', b'route6:', b'origin:', b'descr:', b'source:')
+# Comment lines in IRR dumps
+IRR_COMMENTS = (b'#', b'%')
+# Origin ASN of IRR route objects, optionally followed by a comment
+IRR_ORIGIN_RE = re.compile(rb'AS\s*(\d+)\s*(?:#|$)', re.IGNORECASE)
+DOWNLOAD_WORKERS = 16
+DOWNLOADS_PER_HOST = 2
+DOWNLOAD_BUFFER_SIZE = 1 << 20
+COVERING_CACHE_SIZE = 1 << 16
+CHECK_CACHE_SIZE = 1 << 17
 DEFAULT_RPKI_DIR = CACHE_DIR+'/db/rpki/'
 RPKI_FNAME = '*.*'
 DEFAULT_DELEGATED_DIR = CACHE_DIR+'/db/delegated/'
 DELEGATED_FNAME = '*-stats'
+DEFAULT_SNAPSHOT_DIR = CACHE_DIR+'/db/snapshot/'
+# Change this when the structure of loaded databases changes
+SNAPSHOT_VERSION = 1
 
 DEFAULT_IRR_URLS = [
         # RADB
@@ -87,12 +125,377 @@ def guess_ta_name(url):
     return 'unknown'
 
 
+# Details of a ROA, fields set to None are not available in the source data
+ROA = namedtuple('ROA', ['maxLength', 'ta', 'startTime', 'endTime', 'uri'])
+# Details of an IRR route object
+IRRRoute = namedtuple('IRRRoute', ['descr', 'source'])
+
+
+def roa_to_dict(roa):
+    """Convert ROA or IRRRoute details to a dict, skip unavailable fields"""
+
+    return {k: v for k, v in zip(roa._fields, roa) if v is not None}
+
+
+class ASNIntervals(object):
+    """Static lookup table for disjoint ASN intervals. Intervals are kept in
+    sorted lists and lookups are binary searches on the interval starts."""
+
+    def __init__(self, intervals=()):
+        """intervals: iterable of (start, end, value), bounds are inclusive"""
+
+        intervals = sorted(intervals, key=lambda x: x[0])
+        self.starts = [start for start, _, _ in intervals]
+        self.ends = [end for _, end, _ in intervals]
+        self.values = [value for _, _, value in intervals]
+
+    def get(self, asn, default=None):
+        """Return the value of the interval containing asn, or default"""
+
+        i = bisect.bisect_right(self.starts, asn) - 1
+        if i >= 0 and asn <= self.ends[i]:
+            return self.values[i]
+
+        return default
+
+    def __len__(self):
+        return len(self.starts)
+
+
+def method_cache(method, maxsize):
+    """LRU cache for the given bound method. The cache refers weakly to the
+    instance, so that the instance isn't kept alive by a reference cycle."""
+
+    method_ref = weakref.WeakMethod(method)
+
+    @functools.lru_cache(maxsize=maxsize)
+    def cached(*args):
+        return method_ref()(*args)
+
+    return cached
+
+
+def download_file(url, fpath):
+    """Download the given URL to fpath. RIPE's RPKI archive files (csv.xz)
+    are decompressed on the fly."""
+
+    sys.stderr.write(f'Downloading: {url}\n')
+
+    # Write to a temporary file, an interrupted transfer must not leave a
+    # truncated database. Hidden files are ignored when databases are loaded.
+    folder, fname = os.path.split(fpath)
+    tmp_fpath = os.path.join(folder, f'.{fname}.tmp')
+
+    try:
+        # to separete csv.xz file to decompress
+        if "roas.csv.xz" in url:
+            with closing(request.urlopen(url)) as response:
+                with lzma.open(response) as r:
+                    with open(tmp_fpath, 'wb') as f:
+                        shutil.copyfileobj(r, f, DOWNLOAD_BUFFER_SIZE)
+        else:
+            with closing(request.urlopen(url)) as r:
+                with open(tmp_fpath, 'wb') as f:
+                    shutil.copyfileobj(r, f, DOWNLOAD_BUFFER_SIZE)
+
+        os.replace(tmp_fpath, fpath)
+    except urllib.error.URLError:
+        sys.stderr.write(f'Error {url} is not available.\n')
+    finally:
+        if os.path.exists(tmp_fpath):
+            os.remove(tmp_fpath)
+
+
+def available_cpus():
+    """Number of CPUs this process is allowed to run on"""
+
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+
+    return os.cpu_count() or 1
+
+
+def parse_files(parser, fnames, workers=1):
+    """Run the given parser on each file. With workers > 1 files are parsed
+    in that many parallel processes, and only a few parsed files wait in
+    memory until the caller consumes them.
+    Return: iterator over the parser results, in the order of fnames"""
+
+    workers = min(workers, len(fnames))
+    if workers <= 1:
+        for fname in fnames:
+            yield parser(fname)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for fname in fnames:
+            pending.append(executor.submit(parser, fname))
+            # one queued file per worker keeps the pool busy while the
+            # caller consumes results
+            if len(pending) > workers:
+                yield pending.popleft().result()
+
+        while pending:
+            yield pending.popleft().result()
+
+
+def parse_delegated_file(fname):
+    """Parse a delegated-stats file. 
+    Return: list of (network, prefix length, data) and list of 
+    (first ASN, last ASN, data)"""
+
+    sys.stderr.write(f'Loading: {fname}\n')
+    prefixes = []
+    asns = []
+
+    # Read delegated-stats file. see documentation:
+    # https://www.nro.net/wp-content/uploads/nro-extended-stats-readme5.txt
+    with open(fname, 'r') as fd:
+        # Current run of consecutive ASN records with the same registry and
+        # status: first ASN and first ASN after the run
+        run_start = None
+        run_next = None
+        run_registry = None
+        run_status = None
+
+        def asn_interval():
+            return (run_start, run_next-1, {
+                'status': sys.intern(run_status),
+                'registry': sys.intern(run_registry)
+                })
+
+        for line in fd:
+            # skip comments
+            if line.strip().startswith('#'):
+                continue
+
+            # skip version and summary lines
+            fields_value = line.split('|')
+            if len(fields_value) < 8:
+                continue
+
+            # parse records
+            registry, cc, rtype, start, value, date, status = fields_value[:7]
+
+            # ASN records
+            if rtype == 'asn':
+                start = int(start)
+                if( run_start is not None
+                    and not (run_registry == registry
+                        and run_status == status
+                        and run_next == start)):
+
+                    # store the previous interval and start a new one
+                    asns.append(asn_interval())
+                    run_start = None
+
+                if run_start is None:
+                    run_start = start
+                    run_registry = registry
+                    run_status = status
+
+                run_next = start+int(value)
+
+            # prefix records
+            elif rtype == 'ipv4' or rtype == 'ipv6':
+
+                if run_start is not None:
+                    # stored the last ASN interval
+                    asns.append(asn_interval())
+                    run_start = None
+
+                # compute prefix length, IPv4 values are numbers of
+                # addresses: floor(32-log2(value)) computed with integers
+                if rtype == 'ipv4':
+                    prefix_len = 32-(int(value)-1).bit_length()
+                elif rtype == 'ipv6':
+                    prefix_len = int(value)
+
+                prefix = f"{start}/{prefix_len}"
+                # There are only a few distinct values for these fields,
+                # intern them to share the same string objects
+                prefixes.append( (start, prefix_len, {
+                    'status': sys.intern(status),
+                    'prefix': prefix,
+                    'date': sys.intern(date),
+                    'registry': sys.intern(registry),
+                    'country': sys.intern(cc)
+                    }) )
+
+        if run_start is not None:
+            # the file ends with ASN records
+            asns.append(asn_interval())
+
+    return prefixes, asns
+
+
+def read_rpki_csv(fd, ta):
+    """Read ROAs from a CSV file of RIPE's RPKI archive.
+    Return: iterator over ROA dicts, same fields as the JSON export"""
+
+    rows = csv.reader(fd, delimiter=',')
+
+    # skip the header
+    next(rows)
+
+    for row in rows:
+        # Assume the same format as the one in RIPE archive
+        # https://ftp.ripe.net/ripe/rpki/
+        maxLength = int(row[3]) if row[3] else int(row[2].rpartition('/')[2])
+        yield {
+            'uri': row[0],
+            'asn': row[1],
+            'prefix': row[2],
+            'maxLength': maxLength,
+            'startTime': row[4],
+            'endTime': row[5],
+            'ta': ta
+            }
+
+
+def parse_rpki_file(fname):
+    """Parse a RPKI file (JSON export or CSV from RIPE's archive).
+    Return: list of (prefix, asn, roa details)"""
+
+    sys.stderr.write(f'Loading: {fname}\n')
+    roas = []
+    if fname.endswith('.json'):
+        mode = 'rb'
+    elif fname.endswith('.csv'):
+        mode = 'r'
+    else:
+        sys.stderr.write('Error: Unknown file format for RPKI data!')
+        return roas
+
+    with open(fname, mode) as fd:
+        if fname.endswith('.csv'):
+            recs = read_rpki_csv(fd, guess_ta_name(fname))
+        elif ijson is not None:
+            # Stream ROAs instead of loading the whole document in memory
+            recs = ijson.items(fd, 'roas.item')
+        elif orjson is not None:
+            recs = orjson.loads(fd.read())['roas']
+        else:
+            recs = json.load(fd)['roas']
+
+        for rec in recs:
+            if( isinstance(rec['asn'], str) 
+                    and rec['asn'].startswith('AS') ):
+                asn = int(rec['asn'][2:])
+            else:
+                asn = int(rec['asn'])
+
+            roa_details = ROA(
+                    rec['maxLength'],
+                    sys.intern(rec['ta']),
+                    rec.get('startTime'),
+                    rec.get('endTime'),
+                    rec.get('uri')
+                    )
+
+            roas.append( (rec['prefix'], asn, roa_details) )
+
+    return roas
+
+
+def parse_irr_file(fname):
+    """Parse a gzipped IRR dump.
+    Return: list of (prefix, asn, route details)"""
+
+    sys.stderr.write(f'Loading: {fname}\n')
+    routes = []
+    # Decompress in binary mode with a large read buffer, text mode
+    # gzip is much slower. Values are decoded only when stored.
+    with open(fname, 'rb') as raw, \
+            GzipFile(fileobj=raw) as gz, \
+            io.BufferedReader(gz, buffer_size=IRR_READ_BUFFER_SIZE) as fd:
+
+        rec = {}
+        field = b''
+        # Descriptions are often repeated across a maintainer's routes,
+        # decode them once and share the string objects
+        descrs = {}
+        for line in fd:
+            line = line.strip()
+
+            # Fields that are stored, most lines are other attributes 
+            # (mnt-by, changed, remarks...) and are rejected with the
+            # cheap prefix test below
+            if line.startswith(IRR_FIELDS):
+                field, _, value = line.partition(b':')
+                # Make same field name for IPv4 and IPv6
+                if field == b'route6':
+                    field = b'route'
+                # Values are lists of lines, joined only when the
+                # record is stored
+                rec[field] = [value.strip()]
+
+            elif line == b'':
+                # Store the last record
+                if b'route' in rec:
+                    if b'origin' not in rec:
+                        # we may be in a 'descr' empty line
+                        if field in rec:
+                            rec[field].append(line)
+                        continue
+
+                    match = IRR_ORIGIN_RE.match(rec[b'origin'][0])
+                    if match is None:
+                        sys.stderr.write(f'Error in {fname}, invalid ASN!\n{rec}\n')
+                        rec = {}
+                        field = b''
+                        continue
+                    asn = int(match.group(1))
+
+                    descr = b'\n'.join(rec.get(b'descr', []))
+                    descr_str = descrs.get(descr)
+                    if descr_str is None:
+                        descr_str = descrs[descr] = descr.decode('ISO-8859-1')
+
+                    routes.append( (
+                        rec[b'route'][0].decode('ISO-8859-1'), 
+                        asn, 
+                        IRRRoute(
+                            descr_str,
+                            # few distinct sources, share the string objects
+                            sys.intern(rec.get(b'source', [b''])[0].decode('ISO-8859-1'))
+                        )) )
+
+                rec = {}
+                field = b''
+
+            # Skip comments and remarks
+            elif line.startswith(IRR_COMMENTS):
+                continue
+
+            elif b':' in line:
+                # Attribute that is not stored
+                field = None
+
+            elif field == b'descr':
+                # Multiline value
+                rec[field].append(line)
+
+    return routes
+
+
 class ROV(object):
 
     def __init__( self, irr_urls=DEFAULT_IRR_URLS, rpki_urls=DEFAULT_RPKI_URLS, 
             delegated_urls=DEFAULT_DELEGATED_URLS, irr_dir=DEFAULT_IRR_DIR, 
-            rpki_dir=DEFAULT_RPKI_DIR, delegated_dir=DEFAULT_DELEGATED_DIR ):
-        """Initialize ROV object with databases URLs"""
+            rpki_dir=DEFAULT_RPKI_DIR, delegated_dir=DEFAULT_DELEGATED_DIR,
+            snapshot_dir=DEFAULT_SNAPSHOT_DIR, workers=1 ):
+        """Initialize ROV object with databases URLs. 
+
+        Parsed databases are saved in snapshot_dir and reused by
+        load_databases until the downloaded files change. Set 
+        snapshot_dir=None to always parse the downloaded files.
+
+        workers is the number of processes used to parse databases files,
+        set workers=None to use all available CPUs. With more than one
+        worker load_databases must be called from the main module under
+        an `if __name__ == '__main__':` guard on macOS and Windows."""
 
         self.urls = {}
         self.urls[irr_dir] = irr_urls
@@ -102,6 +505,8 @@ class ROV(object):
         self.irr_dir = irr_dir
         self.rpki_dir = rpki_dir
         self.delegated_dir = delegated_dir
+        self.snapshot_dir = snapshot_dir
+        self.workers = available_cpus() if workers is None else workers
 
         self.roas = {
                 'irr': radix.Radix(), 
@@ -109,9 +514,24 @@ class ROV(object):
                 }
         self.delegated = {
                 'prefix': radix.Radix(),
-                'asn': portion.IntervalDict()
+                'asn': ASNIntervals()
                 }
 
+        # Memoize tree searches, batch validations often query the same
+        # prefix several times (e.g. for different origin ASNs), and ROA
+        # states of repeated queries. Caches are cleared each time a
+        # database is loaded.
+        self._covering_nodes = method_cache(
+                self._search_covering, COVERING_CACHE_SIZE)
+        self._cached_roa_states = method_cache(
+                self._search_roa_states, CHECK_CACHE_SIZE)
+
+    def _clear_caches(self):
+        """Clear memoized results, they are invalid once databases change"""
+
+        self._covering_nodes.cache_clear()
+        self._cached_roa_states.cache_clear()
+
     def load_databases(self):
         """Load databases into memory. Also download databases if it is not 
         available locally."""
@@ -119,250 +539,172 @@ class ROV(object):
         # Make sure we have databases to load
         self.download_databases(overwrite=False)
 
-        self.load_delegated()
-        self.load_irr()
-        self.load_rpki()
+        for name, folder, pattern, load in self._databases():
+            if self.snapshot_dir is None:
+                load()
+                continue
+
+            fname = self._snapshot_fname(name, folder)
+            signature = self._databases_signature(folder, pattern)
+            if not self._load_snapshot(name, fname, signature):
+                load()
+                self._save_snapshot(name, fname, signature)
+
+    def _databases(self):
+        """Return: list of (name, folder, file name pattern, loading method)
+        for each database"""
+
+        return [
+                ('delegated', self.delegated_dir, DELEGATED_FNAME, self.load_delegated),
+                ('irr', self.irr_dir, IRR_FNAME, self.load_irr),
+                ('rpki', self.rpki_dir, RPKI_FNAME, self.load_rpki),
+                ]
+
+    def _snapshot_fname(self, name, folder):
+        """Snapshot file name, one file per database and folder"""
+
+        key = hashlib.sha256(folder.encode()).hexdigest()[:16]
+
+        return os.path.join(self.snapshot_dir, f'{name}-{key}.pkl')
+
+    def _databases_signature(self, folder, pattern):
+        """Compute a hash of the names, modification times and sizes of 
+        the databases files"""
+
+        signature = hashlib.sha256(str(SNAPSHOT_VERSION).encode())
+        for fname in sorted(glob.glob(folder+pattern)):
+            stat = os.stat(fname)
+            signature.update(f'{fname}|{stat.st_mtime_ns}|{stat.st_size}\n'.encode())
+
+        return signature.hexdigest()
+
+    def _load_snapshot(self, name, fname, signature):
+        """Load the database from the snapshot if it matches the given 
+        signature. Return: True if the snapshot was loaded"""
+
+        if not os.path.exists(fname):
+            return False
+
+        try:
+            with open(fname, 'rb') as fd:
+                # The signature is the first record, the database is read
+                # only if it is up to date
+                if pickle.load(fd) != signature:
+                    sys.stderr.write(f'Snapshot {fname} is outdated, parsing databases\n')
+                    return False
+
+                sys.stderr.write(f'Loading: {fname}\n')
+                data = pickle.load(fd)
+        except Exception as e:
+            sys.stderr.write(f'Error: could not read snapshot {fname} ({e})\n')
+            return False
+
+        self._clear_caches()
+        if name == 'delegated':
+            self.delegated = data
+        else:
+            self.roas[name] = data
+
+        return True
+
+    def _save_snapshot(self, name, fname, signature):
+        """Save the loaded database and its signature in the snapshot"""
+
+        data = self.delegated if name == 'delegated' else self.roas[name]
+        # Write to a temporary file first so that a concurrent process never 
+        # reads a partial snapshot
+        tmp_fname = f'{fname}.{os.getpid()}.tmp'
+
+        # The snapshot is only an optimization, loaded databases are still
+        # usable if it can't be written (e.g. read-only or full disk)
+        try:
+            os.makedirs(self.snapshot_dir, exist_ok=True)
+            with open(tmp_fname, 'wb') as fd:
+                pickle.dump(signature, fd, protocol=pickle.HIGHEST_PROTOCOL)
+                pickle.dump(data, fd, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_fname, fname)
+        except OSError as e:
+            sys.stderr.write(f'Error: could not write snapshot {fname} ({e})\n')
+            if os.path.exists(tmp_fname):
+                os.remove(tmp_fname)
 
     def load_delegated(self):
         """Parse the delegated data, load prefix data in a radix tree and ASN
-        data in a IntervalDict"""
-
-        intervals = defaultdict(list)
-        for fname in glob.glob(self.delegated_dir+DELEGATED_FNAME):
-            sys.stderr.write(f'Loading: {fname}\n')
-            # Read delegated-stats file. see documentation:
-            # https://www.nro.net/wp-content/uploads/nro-extended-stats-readme5.txt
-            fields_name = ['registry', 'cc', 'type', 'start', 'value', 'date', 'status']
-
-            with open(fname, 'r') as fd:
-                previous_rec = {f:'' for f in fields_name}
-                start_interval = None
-
-                for line in fd:
-                    # skip comments
-                    if line.strip().startswith('#'):
-                        continue
+        data in a sorted interval table"""
 
-                    # skip version and summary lines
-                    fields_value = line.split('|')
-                    if len(fields_value) < 8:
-                        continue
+        self._clear_caches()
 
-                    # parse records
-                    rec = dict( zip(fields_name, fields_value))
-                    rec['value'] = int(rec['value'])
-
-                    # ASN records
-                    if rec['type'] == 'asn':
-                        rec['start'] = int(rec['start'])
-                        # first record
-                        if start_interval is None:
-                            start_interval = rec
-
-                        else:
-                            if( previous_rec['registry'] == rec['registry']
-                                and previous_rec['status'] == rec['status']
-                                and previous_rec['start']+previous_rec['value'] == rec['start']):
-
-                                # continue reading the current interval
-                                pass
-
-                            else:
-                                # store the previous interval and start a new one
-                                key = '|'.join( [
-                                            previous_rec['registry'],
-                                            previous_rec['status']
-                                            ])
-                                interval = portion.closed( 
-                                    start_interval['start'],
-                                    previous_rec['start']+previous_rec['value']-1
-                                    )
-                                intervals[key].append(interval)
-
-                                start_interval = rec
-
-                        previous_rec = rec
-
-
-                    # prefix records
-                    elif rec['type'] == 'ipv4' or rec['type'] == 'ipv6':
-
-                        if previous_rec['type'] == 'asn':
-                            # stored the last ASN interval
-                            interval = portion.closed( 
-                                start_interval['start'],
-                                previous_rec['start']+previous_rec['value']-1
-                                )
-                            self.delegated['asn'][interval] = {
-                                    'status': previous_rec['status'],
-                                    'registry': previous_rec['registry']
-                                    }
-                            start_interval = None
-                            previous_rec = {f:'' for f in fields_name}
-
-                        # compute prefix length
-                        if rec['type'] == 'ipv4':
-                            prefix_len = int(32-math.log2(rec['value']))
-                        elif rec['type'] == 'ipv6':
-                            prefix_len = int(rec['value'])
-
-                        prefix = f"{rec['start']}/{prefix_len}"
-                        rnode = self.delegated['prefix'].search_exact(prefix)
-                        if rnode is None:
-                            rnode = self.delegated['prefix'].add(prefix)
-
-                        rnode.data['status'] = rec['status']
-                        rnode.data['prefix'] = prefix
-                        rnode.data['date'] = rec['date']
-                        rnode.data['registry'] = rec['registry']
-                        rnode.data['country'] = rec['cc']
-
-
-            # Fast way to populate IntervalDict
-            for value, interval_list in intervals.items():
-
-                registry, status = value.split('|')
-                interval = portion.Interval(*interval_list)
-                self.delegated['asn'][interval] = {
-                    'status': status,
-                    'registry': registry
-                    }
+        asn_intervals = []
+        fnames = glob.glob(self.delegated_dir+DELEGATED_FNAME)
+        for prefixes, asns in parse_files(parse_delegated_file, fnames, self.workers):
+            for network, prefix_len, data in prefixes:
+                # Give address and length separately, radix doesn't have to
+                # parse the prefix string. add() returns the existing node if
+                # the prefix is already in the tree.
+                rnode = self.delegated['prefix'].add(network, prefix_len)
 
+                rnode.data.update(data)
 
-    def load_rpki(self):
-        """Parse the RPKI data and load it in a radix tree"""
+            asn_intervals.extend(asns)
 
-        for fname in glob.glob(self.rpki_dir+RPKI_FNAME):
-            sys.stderr.write(f'Loading: {fname}\n')
-            with open(fname, 'r') as fd:
-                if fname.endswith('.json'):
-                    data = json.load(fd)
-                elif fname.endswith('.csv'):
-                    ta = guess_ta_name(fname)
-                    data = {'roas': [] }
-                    rows = csv.reader(fd, delimiter=',')
-
-                    # skip the header
-                    next(rows)
-
-                    for row in rows:
-                        # Assume the same format as the one in RIPE archive
-                        # https://ftp.ripe.net/ripe/rpki/
-                        maxLength = int(row[3]) if row[3] else int(row[2].rpartition('/')[2])
-                        data['roas'].append( {
-                            'uri': row[0],
-                            'asn': row[1],
-                            'prefix': row[2],
-                            'maxLength': maxLength,
-                            'startTime': row[4],
-                            'endTime': row[5],
-                            'ta': ta
-                            } )
-
-                else:
-                    sys.stderr.write('Error: Unknown file format for RPKI data!')
-                    return 
-
-
-                for rec in data['roas']:
-                    if( isinstance(rec['asn'], str) 
-                            and rec['asn'].startswith('AS') ):
-                        asn = int(rec['asn'][2:])
-                    else:
-                        asn = int(rec['asn'])
-
-                    rnode = self.roas['rpki'].search_exact(rec['prefix'])
-                    if rnode is None:
-                        rnode = self.roas['rpki'].add(rec['prefix'])
-
-                    if asn not in rnode.data:
-                        rnode.data[asn] = []
-
-                    roa_details = {
-                            'maxLength': rec['maxLength'],
-                            'ta': rec['ta']
-                        }
+        self.delegated['asn'] = ASNIntervals(asn_intervals)
 
-                    if 'startTime' in rec:
-                        roa_details['startTime'] = rec['startTime']
-                        roa_details['endTime'] = rec['endTime']
+    def load_rpki(self):
+        """Parse the RPKI data and load it in a radix tree"""
 
-                    if 'uri' in rec:
-                        roa_details['uri'] = rec['uri']
+        self._clear_caches()
 
-                    rnode.data[asn].append( roa_details )
+        fnames = glob.glob(self.rpki_dir+RPKI_FNAME)
+        for roas in parse_files(parse_rpki_file, fnames, self.workers):
+            self._add_roas(self.roas['rpki'], roas)
 
     def load_irr(self):
         """Parse the IRR data and load it in a radix tree"""
 
-        for fname in glob.glob(self.irr_dir+IRR_FNAME):
-            sys.stderr.write(f'Loading: {fname}\n')
-            with gzip.open(fname, 'rt', 
-                    newline='\n', encoding='ISO-8859-1', errors='ignore') as fd:
+        self._clear_caches()
 
-                rec = {}
-                field = ''
-                for line in fd:
-                    line = line.strip()
+        fnames = glob.glob(self.irr_dir+IRR_FNAME)
+        for routes in parse_files(parse_irr_file, fnames, self.workers):
+            self._add_roas(self.roas['irr'], routes)
 
-                    # Skip comments and remarks
-                    if line.startswith('#') or line.startswith('%'):
-                        continue
+    def _add_roas(self, rtree, roas):
+        """Insert (prefix, asn, details) records in the given radix tree"""
 
-                    if line == '':
-                        # Store the last record
-                        if 'route' in rec:
-                            if 'origin' not in rec:
-                                # we may be in a 'descr' empty line
-                                rec[field] += '\n'+line
-                                continue
+        # add() returns the existing node if the prefix is already in the
+        # tree, no need for a separate search
+        for prefix, asn, details in roas:
+            data = rtree.add(prefix).data
+            if asn not in data:
+                data[asn] = []
 
-                            rnode = self.roas['irr'].search_exact(rec['route'])
-                            try:
-                                asn = int(rec['origin'][2:].partition('#')[0])
-                            except ValueError:
-                                sys.stderr.write(f'Error in {fname}, invalid ASN!\n{rec}\n')
-                                continue
+            data[asn].append( details )
 
-                            if rnode is None:
-                                rnode = self.roas['irr'].add(rec['route'])
+    def _search_covering(self, prefix: str):
+        """Search the nodes matching the given prefix.
+        Return: dict with the covering nodes of each ROA tree and the best
+        matching node in the delegated tree"""
 
-                            if asn not in rnode.data:
-                                rnode.data[asn] = []
-
-                            rnode.data[asn].append({
-                                'descr':  rec.get('descr', '') ,
-                                'source': rec.get('source', '') 
-                                })
+        covering = {}
+        for name, rtree in self.roas.items():
+            covering[name] = rtree.search_covering(prefix)
 
-                        rec = {}
-                        field = ''
-
-                    else:
-                        # New field
-                        if ':' in line:
-                            field, _, value = line.partition(":")
-                            # Make same field name for IPv4 and IPv6
-                            if field == 'route6':
-                                field = 'route'
-                            rec[field] = value.strip()
-                        else:
-                            # Multiline value
-                            if field in rec and field in ['descr', 'addr']:
-                                rec[field] += '\n'+line
+        return covering, self.delegated['prefix'].search_best(prefix)
 
     def lookup(self, prefix: int):
         """Search for entries for prefixes covering the given prefix.
         Return: dict will all matching entries"""
 
         res = defaultdict(dict)
-        for name, rtree in self.roas.items():
-            rnodes = rtree.search_covering(prefix)
+        covering, delegated_rnode = self._covering_nodes(prefix)
+        for name, rnodes in covering.items():
             for rnode in rnodes:
-                res[name][rnode.prefix] = rnode.data
+                res[name][rnode.prefix] = {
+                        asn: [roa_to_dict(roa) for roa in roas]
+                        for asn, roas in rnode.data.items()
+                        }
 
         # Check status in delegated stats
-        rnode = self.delegated['prefix'].search_best(prefix)
+        rnode = delegated_rnode
         if rnode is not None:
             res['delegated'] = rnode.data
 
@@ -373,63 +715,119 @@ class ROV(object):
         """Compute the state of the given prefix, origin ASN pair"""
 
         origin_asn = int(origin_asn)
+        roa_states, delegated_rnode = self._cached_roa_states(prefix, origin_asn)
+
+        return self._check_report(prefix, origin_asn, roa_states, delegated_rnode)
+
+    def _search_roa_states(self, prefix: str, origin_asn: int):
+        """Search the trees and compute the ROA states of the given prefix,
+        origin ASN pair.
+        Return: ROA states and best matching node in the delegated tree"""
+
+        covering, delegated_rnode = self._covering_nodes(prefix)
+
+        return self._roa_states(prefix, origin_asn, covering), delegated_rnode
+
+    def check_many(self, pairs: Iterable[Tuple[str, int]]):
+        """Compute the states of many (prefix, origin ASN) pairs. Trees are
+        searched only once for each distinct prefix.
+        Return: list of states in the same order as the given pairs"""
+
+        pairs = list(pairs)
+        indices = defaultdict(list)
+        for i, (prefix, _) in enumerate(pairs):
+            indices[prefix].append(i)
+
+        states = [None] * len(pairs)
+        for prefix, prefix_indices in indices.items():
+            covering, delegated_rnode = self._search_covering(prefix)
+            for i in prefix_indices:
+                origin_asn = int(pairs[i][1])
+                roa_states = self._roa_states(prefix, origin_asn, covering)
+                states[i] = self._check_report(
+                        prefix, origin_asn, roa_states, delegated_rnode)
+
+        return states
+
+    def _roa_states(self, prefix: str, origin_asn: int, covering):
+        """Compute the state of the given prefix, origin ASN pair in each ROA
+        tree from the nodes found by _search_covering.
+        Return: tuple of (tree name, status, selected prefix, selected roa)"""
+
         prefix_in = prefix.strip()
         prefixlen = int(prefix_in.partition('/')[2])
-        states = {}
-
-        # include the query in the results
-        states['query'] = {
-                'prefix': prefix,
-                'asn': origin_asn
-                }
+        roa_states = []
 
         # Check routing status
-        for name, rtree in self.roas.items():
+        for name, rnodes in covering.items():
             # Default to NotFound 
+            status = 'NotFound'
+            selected_rnode = None
             selected_roa = None
-            status = {'status': 'NotFound'}
 
-            rnodes = rtree.search_covering(prefix)
             if len(rnodes) > 0:
                 # report invalid with the first roa of the most specific prefix
-                rnode = rnodes[0]
-                status = {'status': 'Invalid', 'prefix': rnode.prefix}
-                key = next(iter(rnode.data.keys()))
-                selected_roa = rnode.data[key][0]
+                selected_rnode = rnodes[0]
+                status = 'Invalid'
+                key = next(iter(selected_rnode.data.keys()))
+                selected_roa = selected_rnode.data[key][0]
 
+            # All covering prefixes are checked, a less specific ROA with a 
+            # larger maxLength can validate the prefix
             for rnode in rnodes:
-                if origin_asn in rnode.data: # Matching ASN
-
-                    for roa in rnode.data[origin_asn]:
-                        status = {'status': 'Invalid,more-specific', 'prefix': rnode.prefix}
+                # Skip prefixes without ROA for this ASN with a single lookup
+                roas = rnode.data.get(origin_asn)
+                if roas is not None: # Matching ASN
+
+                    status = 'Invalid,more-specific'
+                    selected_rnode = rnode
+                    exact_match = (prefix_in == rnode.prefix)
+                    for roa in roas:
                         selected_roa = roa
 
                         # check prefix length
-                        if( ('maxLength' in roa and roa['maxLength'] >= prefixlen) 
-                            or (prefix_in == rnode.prefix)):
+                        if exact_match or getattr(roa, 'maxLength', -1) >= prefixlen:
+                            status = 'Valid'
+                            break
 
-                                status = {'status': 'Valid', 'prefix': rnode.prefix}
-                                selected_roa = roa
+                    if status == 'Valid':
+                        break
 
-                                break
+            selected_prefix = None
+            if selected_rnode is not None:
+                selected_prefix = selected_rnode.prefix
 
-                    if status['status'] == 'Valid':
-                        break
+            roa_states.append( (name, status, selected_prefix, selected_roa) )
+
+        return tuple(roa_states)
+
+    def _check_report(self, prefix: str, origin_asn: int, roa_states, delegated_rnode):
+        """Build the status report of the given prefix, origin ASN pair"""
+
+        states = {}
+
+        # include the query in the results
+        states['query'] = {
+                'prefix': prefix,
+                'asn': origin_asn
+                }
 
-            # copy roa attributes in the status report
-            if selected_roa is not None:
-                for k,v in selected_roa.items():
-                    status[k] = v
+        for name, status, selected_prefix, selected_roa in roa_states:
+            report = {'status': status}
+            if selected_prefix is not None:
+                report['prefix'] = selected_prefix
+                # copy roa attributes in the status report
+                report.update(roa_to_dict(selected_roa))
 
-            states[name] = status
+            states[name] = report
                         
         # Check status in delegated stats
-        rnode = self.delegated['prefix'].search_best(prefix)
+        rnode = delegated_rnode
         prefix_data = {'status': 'NotFound'}
         if rnode is not None:
             prefix_data = rnode.data
 
-        asn = self.delegated['asn'].get(int(origin_asn), {'status': 'NotFound'})
+        asn = self.delegated['asn'].get(origin_asn, {'status': 'NotFound'})
 
         states['delegated'] = {
                 'prefix': prefix_data,
@@ -447,12 +845,18 @@ class ROV(object):
 
         # TODO implement automatic update based on dates
 
+        downloads = []
         for folder, urls in self.urls.items():
 
             # Clear the whole cache if overwrite
             if overwrite and os.path.exists(folder):
                 shutil.rmtree(folder)
 
+            # Snapshots of the replaced files are useless
+            if overwrite and self.snapshot_dir is not None:
+                for fname in glob.glob(self._snapshot_fname('*', folder)):
+                    os.remove(fname)
+
             # Create the folder if needed
             os.makedirs(folder, exist_ok=True)
 
@@ -468,19 +872,30 @@ class ROV(object):
                 if os.path.exists(folder+fname) and not overwrite:
                     continue
 
-                sys.stderr.write(f'Downloading: {url}\n')
-        
-                try:
-                    # to separete csv.xz file to decompress
-                    if "roas.csv.xz" in url:
-                        with closing(request.urlopen(url)) as response:
-                            with lzma.open(BytesIO(response.read())) as r:
-                                with open(folder+fname, 'wb') as f:
-                                    shutil.copyfileobj(r,f)
-                    else:
-                        with closing(request.urlopen(url)) as r:
-                            with open(folder+fname, 'wb') as f:
-                                shutil.copyfileobj(r, f)
-                except urllib.error.URLError:
-                    sys.stderr.write(f'Error {url} is not available.\n')
-                    
+                downloads.append( (url, folder+fname) )
+
+        if not downloads:
+            return
+
+        # Downloads are network bound, fetch files concurrently but open only
+        # a few connections to each server, FTP servers reject too many
+        # sessions from the same address
+        hosts = defaultdict(list)
+        for url, fpath in downloads:
+            hosts[urllib.parse.urlsplit(url).netloc].append( (url, fpath) )
+
+        slots = { host: threading.BoundedSemaphore(DOWNLOADS_PER_HOST)
+                for host in hosts }
+
+        def download(url, fpath):
+            with slots[urllib.parse.urlsplit(url).netloc]:
+                download_file(url, fpath)
+
+        # Interleave servers so that workers don't all wait for the same one
+        downloads = [ entry
+                for entries in itertools.zip_longest(*hosts.values())
+                for entry in entries if entry is not None ]
+
+        max_workers = min(len(downloads), DOWNLOAD_WORKERS)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            list(executor.map(download, *zip(*downloads)))
@@ -38,6 +38,11 @@ def main():
             help='Load past RPKI data for the given date (format is year/mo/da). \
                     The given date should be greater than 2018/04/04.',
             )
+    parser.add_argument(
+            '--workers',
+            type=int,
+            help='Number of processes used to parse databases (default to the number of available CPUs)',
+            )
     parser.add_argument(
             '--interactive',
             help='Open an interactive python shell with databases loaded in "rov".',
@@ -56,7 +61,7 @@ def main():
             rpki_url.append( url.format(year=int(year), month=int(month), day=int(day)) )
 
     # Main program
-    rov = ROV(args.irr_url, rpki_url, rpki_dir=rpki_dir)
+    rov = ROV(args.irr_url, rpki_url, rpki_dir=rpki_dir, workers=args.workers)
 
     # Download databases
     rov.download_databases(args.update)
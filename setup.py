@@ -16,8 +16,7 @@ setup(
     packages = find_packages(),
     install_requires=[
         'appdirs',
-        'py-radix',
-        'portion'
+        'py-radix'
     ],
     entry_points={'console_scripts':
             ['rov = rov.__main__:main']},
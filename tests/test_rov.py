@@ -1,3 +1,12 @@
+import collections
+import gzip
+import json
+import lzma
+import os
+import threading
+import time
+import weakref
+
 import pytest
 import rov
 
@@ -103,3 +112,264 @@ def test_query(default_rov):
     assert res["query"]["prefix"] == '8.8.8.0/24'
     assert res["query"]["asn"] == 15169
     
+
+def test_asn_intervals():
+    intervals = rov.ASNIntervals([
+        (20, 29, {'status': 'assigned'}),
+        (1, 10, {'status': 'reserved'}),
+        ])
+    assert intervals.get(1)['status'] == 'reserved'
+    assert intervals.get(10)['status'] == 'reserved'
+    assert intervals.get(25)['status'] == 'assigned'
+    assert intervals.get(0) is None
+    assert intervals.get(15, {'status': 'NotFound'})['status'] == 'NotFound'
+    assert intervals.get(30) is None
+
+def test_check_many(default_rov):
+    routes = [('8.8.8.0/24', 15169), ('8.8.8.0/24', 123), ('10.1.0.0/16', 15169)]
+    states = default_rov.check_many(routes)
+    assert states == [default_rov.check(prefix, asn) for prefix, asn in routes]
+
+
+# Offline tests on small databases
+DELEGATED_STATS = """2|nro|20230101|10|19821231|20230101|+0000
+nro|*|asn|*|3|summary
+arin|US|asn|15169|1|20000101|assigned|x|e-stats
+arin|US|ipv4|8.0.0.0|8388608|19921201|assigned|x|e-stats
+"""
+
+IRR_DUMP = b"""route: 8.8.8.0/24
+descr: Google
+origin: AS15169
+source: RADB
+
+"""
+
+RPKI_EXPORT = {'roas': [
+    {'asn': 'AS15169', 'prefix': '8.8.8.0/24', 'maxLength': 24, 'ta': 'arin'},
+    ]}
+
+
+@pytest.fixture
+def db_dirs(tmp_path):
+    dirs = {}
+    for name in ['irr', 'rpki', 'delegated', 'snapshot']:
+        dirs[name] = str(tmp_path / name)+'/'
+        os.makedirs(dirs[name])
+
+    with gzip.open(dirs['irr']+'test.db.gz', 'wb') as fd:
+        fd.write(IRR_DUMP)
+    with open(dirs['rpki']+'export.json', 'w') as fd:
+        json.dump(RPKI_EXPORT, fd)
+    with open(dirs['delegated']+'test-stats', 'w') as fd:
+        fd.write(DELEGATED_STATS)
+
+    return dirs
+
+
+def offline_rov(dirs):
+    return rov.ROV([], [], [], irr_dir=dirs['irr'], rpki_dir=dirs['rpki'],
+            delegated_dir=dirs['delegated'], snapshot_dir=dirs['snapshot'])
+
+
+def test_snapshot(db_dirs, monkeypatch):
+    expected = offline_rov(db_dirs)
+    expected.load_databases()
+    assert expected.check('8.8.8.0/24', 15169)['rpki']['status'] == 'Valid'
+
+    # up to date snapshots are loaded without parsing files
+    def fail(fname):
+        raise AssertionError(f'{fname} parsed')
+
+    for parser in ['parse_delegated_file', 'parse_irr_file', 'parse_rpki_file']:
+        monkeypatch.setattr(rov, parser, fail)
+
+    srov = offline_rov(db_dirs)
+    srov.load_databases()
+    assert srov.check('8.8.8.0/24', 15169) == expected.check('8.8.8.0/24', 15169)
+
+    # modified files are parsed again, other databases come from snapshots
+    parsed = []
+    def parse_rpki_file(fname):
+        parsed.append(fname)
+        return []
+
+    monkeypatch.setattr(rov, 'parse_rpki_file', parse_rpki_file)
+    fname = db_dirs['rpki']+'export.json'
+    stat = os.stat(fname)
+    os.utime(fname, ns=(stat.st_atime_ns, stat.st_mtime_ns+10**9))
+
+    srov = offline_rov(db_dirs)
+    srov.load_databases()
+    assert parsed == [fname]
+    assert srov.check('8.8.8.0/24', 15169)['rpki']['status'] == 'NotFound'
+    assert srov.check('8.8.8.0/24', 15169)['irr']['status'] == 'Valid'
+
+    # the rebuilt snapshot is used next time
+    parsed.clear()
+    offline_rov(db_dirs).load_databases()
+    assert parsed == []
+
+    # snapshots are removed with the files they were built from
+    srov.download_databases(overwrite=True)
+    assert os.listdir(db_dirs['snapshot']) == []
+
+
+def test_check_cache(db_dirs):
+    crov = offline_rov(db_dirs)
+    crov.load_databases()
+
+    # each call returns a new report
+    res = crov.check('8.8.8.0/24', 15169)
+    res['rpki']['peer'] = 'modified'
+    res['query']['asn'] = 0
+    assert crov.check('8.8.8.0/24', 15169) == {
+            'query': {'prefix': '8.8.8.0/24', 'asn': 15169},
+            'irr': {'status': 'Valid', 'prefix': '8.8.8.0/24',
+                'descr': 'Google', 'source': 'RADB'},
+            'rpki': {'status': 'Valid', 'prefix': '8.8.8.0/24',
+                'maxLength': 24, 'ta': 'arin'},
+            'delegated': {
+                'prefix': {'status': 'assigned', 'prefix': '8.0.0.0/9',
+                    'date': '19921201', 'registry': 'arin', 'country': 'US'},
+                'asn': {'status': 'assigned', 'registry': 'arin'}
+                }
+            }
+    routes = [('8.8.8.0/24', 15169), ('8.8.8.0/25', 15169), ('8.8.8.0/24', 123)]
+    assert crov.check_many(routes) == [crov.check(*route) for route in routes]
+
+    # caches don't keep the ROV object alive
+    ref = weakref.ref(crov)
+    del crov
+    assert ref() is None
+
+
+def test_download_per_host(tmp_path, monkeypatch):
+    irr_urls = [f'ftp://ftp.radb.net/radb/dbase/{i}.db.gz' for i in range(10)]
+    irr_urls += [f'ftp://ftp.ripe.net/ripe/dbase/{i}.db.gz' for i in range(10)]
+
+    lock = threading.Lock()
+    active = collections.Counter()
+    max_active = collections.Counter()
+    def download_file(url, fpath):
+        host = url.split('/')[2]
+        with lock:
+            active[host] += 1
+            max_active[host] = max(max_active[host], active[host])
+        time.sleep(0.01)
+        with lock:
+            active[host] -= 1
+
+    monkeypatch.setattr(rov, 'download_file', download_file)
+    drov = rov.ROV(irr_urls, [], [], irr_dir=str(tmp_path)+'/irr/',
+            rpki_dir=str(tmp_path)+'/rpki/', delegated_dir=str(tmp_path)+'/delegated/')
+    drov.download_databases()
+
+    assert max_active == {'ftp.radb.net': 2, 'ftp.ripe.net': 2}
+
+
+def test_download_file(tmp_path):
+    data = b'URI,ASN,IP Prefix,Max Length,Not Before,Not After\n' * 1000
+    archive = tmp_path / 'roas.csv.xz'
+    archive.write_bytes(lzma.compress(data))
+    fpath = str(tmp_path / 'arin.csv')
+
+    rov.download_file(archive.as_uri(), fpath)
+    assert open(fpath, 'rb').read() == data
+
+    # interrupted transfers leave previous files untouched
+    archive.write_bytes(lzma.compress(data)[:100])
+    with pytest.raises(EOFError):
+        rov.download_file(archive.as_uri(), fpath)
+
+    assert open(fpath, 'rb').read() == data
+    assert sorted(os.listdir(tmp_path)) == ['arin.csv', 'roas.csv.xz']
+
+
+def test_parse_irr_file(tmp_path):
+    fname = str(tmp_path / 'test.db.gz')
+    with gzip.open(fname, 'wb') as fd:
+        fd.write(b"""% comment
+# comment
+
+route: 1.0.0.0/24
+descr: First line
+       second line
+origin: AS1
+mnt-by: MAINT-X
+source: RADB
+
+route:  1.0.1.0/24
+descr: Before blank
+
+       after blank
+origin: AS2
+source: RADB
+
+route6: 2001:db8::/32
+descr: v6
+origin: AS3 # comment
+source: RIPE
+
+route: 1.0.2.0/24
+origin: as4
+remarks: first remark
+         continuation of remark
+descr: after remarks
+source: RADB
+
+route: 1.0.3.0/24
+descr: invalid origin
+origin: ASX
+source: RADB
+
+route: 1.0.4.0/24
+origin: AS5
+source: RADB
+
+""")
+
+    assert rov.parse_irr_file(fname) == [
+            ('1.0.0.0/24', 1, rov.IRRRoute('First line\nsecond line', 'RADB')),
+            ('1.0.1.0/24', 2, rov.IRRRoute('Before blank\n\nafter blank', 'RADB')),
+            ('2001:db8::/32', 3, rov.IRRRoute('v6', 'RIPE')),
+            ('1.0.2.0/24', 4, rov.IRRRoute('after remarks', 'RADB')),
+            ('1.0.4.0/24', 5, rov.IRRRoute('', 'RADB')),
+            ]
+
+
+def test_parse_delegated_file(tmp_path):
+    fname = str(tmp_path / 'test-stats')
+    with open(fname, 'w') as fd:
+        fd.write("""2|nro|20230101|10|19821231|20230101|+0000
+nro|*|asn|*|6|summary
+# comment
+iana|ZZ|asn|0|1|19700101|reserved|iana|e-stats
+arin|US|asn|1|10|19840101|assigned|x|e-stats
+arin|CA|asn|11|5|19840101|assigned|x|e-stats
+arin|US|asn|16|4|19840101|available|x|e-stats
+arin|US|ipv4|8.0.0.0|8388608|19921201|assigned|x|e-stats
+apnic|AU|ipv4|1.1.0.0|768|20110811|assigned|x|e-stats
+ripencc|EU|ipv6|2001:db8::|32|20000101|reserved|x|e-stats
+ripencc|EU|asn|20|10|19840101|assigned|x|e-stats
+ripencc|EU|asn|30|2|19840101|assigned|x|e-stats
+""")
+
+    prefixes, asns = rov.parse_delegated_file(fname)
+
+    # consecutive ASNs with the same registry and status are merged
+    assert asns == [
+            (0, 0, {'status': 'reserved', 'registry': 'iana'}),
+            (1, 15, {'status': 'assigned', 'registry': 'arin'}),
+            (16, 19, {'status': 'available', 'registry': 'arin'}),
+            (20, 31, {'status': 'assigned', 'registry': 'ripencc'}),
+            ]
+
+    # IPv4 sizes that are not a power of two give the covering length
+    assert [(network, prefix_len, data['prefix']) for network, prefix_len, data in prefixes] == [
+            ('8.0.0.0', 9, '8.0.0.0/9'),
+            ('1.1.0.0', 22, '1.1.0.0/22'),
+            ('2001:db8::', 32, '2001:db8::/32'),
+            ]
+    assert prefixes[1][2] == {'status': 'assigned', 'prefix': '1.1.0.0/22',
+            'date': '20110811', 'registry': 'apnic', 'country': 'AU'}